@@ -6,12 +6,13 @@ import logging
 
 import serial
 
+from .helpers import SERIAL_BAUDRATE
 from .ws import SUPPORTED_MODELS, main
 
 
 def test_serial_port(potential_serial_port):
-    serial.Serial(port=potential_serial_port, baudrate=115200, timeout=5)
-    return potential_serial_port
+    with serial.Serial(port=potential_serial_port, baudrate=SERIAL_BAUDRATE, timeout=5):
+        return potential_serial_port
 
 
 def find_serial_port():
@@ -18,7 +18,10 @@
 
 import ipaddress
 import logging
+import socket
 import time
+from collections.abc import Sequence
+from contextlib import contextmanager
 from threading import Event
 from typing import Optional, Union
 
@@ -54,81 +57,149 @@ event_keep_serial_active = Event()
 event_abort_ssh = Event()
 event_ssh_ready = Event()
 
+# U-Boot console speed of all supported models, there is no need to fall back to slower rates
+SERIAL_BAUDRATE = 115200
+# Chunk size for the sysupgrade upload, scp defaults to 16 KiB
+SCP_BUFFER_SIZE = 256 * 1024
+# Timeout for each socket operation of the SCP upload
+SCP_SOCKET_TIMEOUT = 30.0
+# Maximum silence on the sysupgrade SSH session before giving up on reading its output
+SSH_READ_TIMEOUT = 60
+# U-Boot shows the backup prompt when booted from the backup image
+UBOOT_PROMPTS = [b"Boot (PRI)->", b"Boot (BAK)->"]
+# Upper bound for a single blocking serial read, so waiting loops still notice when they should stop
+SERIAL_POLL_TIMEOUT = 0.5
+
 
 def debug_serial(string: str):
     logging.debug(string.rstrip())
 
 
+@contextmanager
+def serial_timeout(ser: serial.Serial, timeout: Optional[float]):
+    previous_timeout = ser.timeout
+    ser.timeout = timeout
+    try:
+        yield ser
+    finally:
+        ser.timeout = previous_timeout
+
+
+def wait_for_substring(
+    ser: serial.Serial, markers: Sequence[bytes], timeout: Optional[float] = None
+) -> Optional[bytes]:
+    """Block until one of the markers is received and return it, or None on timeout or when the serial is stopped."""
+    deadline = serial.serialutil.Timeout(timeout)
+    line = b""
+    with serial_timeout(ser, SERIAL_POLL_TIMEOUT):
+        while event_keep_serial_active.is_set() and not deadline.expired():
+            # blocks in the kernel until a full line, the poll timeout or the size limit is reached
+            line += ser.read_until(expected=b"\n", size=4096)
+
+            for marker in markers:
+                if marker in line:
+                    debug_serial(line.decode("ascii", errors="replace"))
+                    return marker
+
+            # Only print full lines to debug output
+            if line.endswith(b"\n") or len(line) >= 4096:
+                debug_serial(line.decode("ascii", errors="replace"))
+                line = b""
+
+    return None
+
+
+def read_until_marker(
+    ser: serial.Serial, markers: Sequence[bytes], timeout: Optional[float] = 30, max_bytes: int = 65536
+) -> bytes:
+    """Read until one of the markers is received and return the (at most max_bytes) data up to and including it.
+
+    Everything the driver has buffered is pulled in a single read, so this must only be used for markers after which
+    the device waits for input (e.g. prompts). On timeout or when the serial is stopped, returns the data read so far.
+    """
+    deadline = serial.serialutil.Timeout(timeout)
+    buffer = b""
+    logged = 0
+    with serial_timeout(ser, SERIAL_POLL_TIMEOUT):
+        while event_keep_serial_active.is_set() and not deadline.expired():
+            search_start = max(0, len(buffer) - max(len(marker) for marker in markers) + 1)
+            # read everything that is already waiting in one call, otherwise block until the next byte arrives
+            buffer += ser.read(ser.in_waiting or 1)
+
+            for marker in markers:
+                marker_index = buffer.find(marker, search_start)
+                if marker_index >= 0:
+                    buffer = buffer[: marker_index + len(marker)]
+                    debug_serial(buffer[logged:].decode("ascii", errors="replace"))
+                    return buffer[-max_bytes:]
+
+            # Only print full lines to debug output
+            line_end = buffer.rfind(b"\n") + 1
+            if line_end > logged:
+                debug_serial(buffer[logged:line_end].decode("ascii", errors="replace"))
+                logged = line_end
+
+            if len(buffer) > max_bytes:
+                overflow = len(buffer) - max_bytes
+                buffer = buffer[overflow:]
+                logged = max(0, logged - overflow)
+
+    if len(buffer) > logged:
+        debug_serial(buffer[logged:].decode("ascii", errors="replace"))
+    return buffer
+
+
+def wait_uboot_prompt(ser: serial.Serial, timeout: float = 10) -> str:
+    output = read_until_marker(ser, UBOOT_PROMPTS, timeout=timeout)
+    # the prompt is the only sign that U-Boot finished the previous command and accepts the next one
+    if event_keep_serial_active.is_set() and not output.endswith(tuple(UBOOT_PROMPTS)):
+        raise RuntimeError(f"U-Boot did not return to its prompt within {timeout}s")
+    return output.decode("ascii", errors="replace")
+
+
+def run_uboot_command(ser: serial.Serial, command: bytes, timeout: float = 10) -> str:
+    ser.write(command)
+    return wait_uboot_prompt(ser, timeout)
+
+
 def bootup_interrupt(ser: serial.Serial):
-    bootlog_buffer = ""
+    interrupt_marker = b"Hit 'd' for diagnostics"
+    if interrupt_marker not in read_until_marker(ser, [interrupt_marker], timeout=None):
+        return
 
-    while event_keep_serial_active.is_set():
-        time.sleep(0.01)
-        if ser.in_waiting == 0:
-            continue
-
-        try:
-            new_data = ser.read(ser.in_waiting).decode("ascii")
-        except UnicodeDecodeError as e:
-            logging.warning(f"Failed to decode serial data: {e}")
-            new_data = str(ser.read(ser.in_waiting))
-        bootlog_buffer += new_data
-
-        # Only print full lines to debug output
-        while "\n" in bootlog_buffer:
-            line_end = bootlog_buffer.find("\n") + 1
-            debug_serial(bootlog_buffer[:line_end])
-            bootlog_buffer = bootlog_buffer[line_end:]
-
-        if "Hit 'd' for diagnostics" in bootlog_buffer:
-            text = b"x"  # send interrupt key
-            debug_serial(bootlog_buffer)  # print remaining debug buffer
-            logging.info(f"Sending interrupt key {text.decode()} to enter Boot prompt.")
-            time.sleep(0.5)  # sleep 500ms
-            ser.write(text)
-            break
+    text = b"x"  # send interrupt key
+    logging.info(f"Sending interrupt key {text.decode()} to enter Boot prompt.")
+    # no need to wait, U-Boot picks the key up from the UART FIFO during its countdown
+    ser.write(text)
 
 
 def bootup_login(ser: serial.Serial):
-    while event_keep_serial_active.is_set():
-        line = readline_from_serial(ser)
+    if wait_for_substring(ser, [b"[30s timeout]"]) is None:
+        return
 
-        if "[30s timeout]" in line:
-            time.sleep(0.1)
-            logging.info("Attempting to log in.")
-            ser.write(b"admin\n")
-            time.sleep(0.1)
-            ser.write(b"new2day\n")
-        elif "password: new2day" in line:
-            time.sleep(0.1)  # sleep 500ms
-            logging.info("Checking if login was successful.")
-            break
+    time.sleep(0.1)
+    logging.info("Attempting to log in.")
+    ser.write(b"admin\n")
+    time.sleep(0.1)
+    ser.write(b"new2day\n")
 
-        time.sleep(0.01)
+    if wait_for_substring(ser, [b"password: new2day"]) is None:
+        return
 
+    time.sleep(0.1)  # sleep 100ms
+    logging.info("Checking if login was successful.")
 
-def bootup_login_verification(ser: serial.Serial):
-    prompt_string = "Boot (PRI)->"
-    prompt_string_backup = "Boot (BAK)->"
-    # The assertion ensures that both prompt strings have the same length, which is crucial
-    # for the buffer reading logic in the loop below. If the strings had different lengths,
-    # the code might not read enough bytes from the buffer to recognize either prompt or
-    # might not receive enough bytes to ever continue.
-    assert len(prompt_string_backup) == len(prompt_string)
-    # Reading byte by byte because there is no linebreak after the prompt
-    while event_keep_serial_active.is_set():
-        # only read chars if there are enough bytes in wait from the buffer
-        if ser.in_waiting > len(prompt_string):
-            chars = ser.read(ser.in_waiting).decode("ascii")
-            debug_serial(chars)
 
-            if prompt_string in chars or prompt_string_backup in chars:
-                logging.info("U-Boot login successful!")
-                break
+def bootup_login_verification(ser: serial.Serial):
+    # There is no linebreak after the prompt, so wait for the prompt itself instead of reading lines
+    login_output = read_until_marker(ser, UBOOT_PROMPTS, timeout=10)
+    if not event_keep_serial_active.is_set():
+        return
 
-            raise RuntimeError("U-Boot login failed :((")
+    if not login_output.endswith(tuple(UBOOT_PROMPTS)):
+        raise RuntimeError("U-Boot login failed :((")
 
-        time.sleep(0.01)
+    logging.info("U-Boot login successful!")
 
 
 def is_kernel_booting(line):
@@ -164,8 +235,6 @@ def boot_wait_for_brlan(ser: serial.Serial):
             time.sleep(2)  # sometimes br-lan is ready but the default IP is still not reachable
             break
 
-        time.sleep(0.1)
-
 
 def boot_set_ips(ser, new_ap_ip):
     logging.info(f"Setting new AP ip to {new_ap_ip}")
@@ -173,43 +242,37 @@ def boot_set_ips(ser, new_ap_ip):
 
     write_to_serial(ser, b"\n")  # login
     write_to_serial(ser, b"ip address del 192.168.1.1 dev br-lan\n")  # remove default IP to avoid collisions
-    write_to_serial(ser, b"ip address add " + ip_str + b" dev br-lan\n")
+    # The quotes keep the echoed command line from matching the confirmation printed after the address was added
+    ser.write(b"ip address add " + ip_str + b' dev br-lan && echo "br-lan ip" added\n')
+    if wait_for_substring(ser, [b"br-lan ip added"], timeout=10) is None and event_keep_serial_active.is_set():
+        raise RuntimeError(f"Failed to set AP ip {new_ap_ip}")
+
+    # the AP is reachable now, the output is logged by keep_logging_until_reboot while SSH connects
     write_to_serial(ser, b"ip -4 address show\n")
-    time.sleep(0.5)
 
 
 def keep_logging_until_reboot(ser: serial.Serial):
     while event_keep_serial_active.is_set():
-        if ser.in_waiting > 5:
-            line = readline_from_serial(ser)
-            if "Upgrade completed" in line:
-                logging.info("Flashing successful.")
-            elif "reboot: Restarting system" in line:
-                logging.info("Reboot detected. Stopping serial connection.")
-                break
-
-        time.sleep(0.05)
+        marker = wait_for_substring(ser, [b"Upgrade completed", b"reboot: Restarting system"])
+        if marker == b"Upgrade completed":
+            logging.info("Flashing successful.")
+        elif marker == b"reboot: Restarting system":
+            logging.info("Reboot detected. Stopping serial connection.")
+            break
 
 
-def write_to_serial(ser: serial.Serial, text: bytes, sleep: float = 0) -> str:
+def write_to_serial(ser: serial.Serial, text: bytes) -> str:
     ser.write(text)
-    if sleep > 0:
-        time.sleep(sleep)
 
-    return_string = ser.readline().decode("ascii")
+    return_string = ser.readline().decode("ascii", errors="replace")
     debug_serial(return_string)
     return return_string
 
 
 def readline_from_serial(ser: serial.Serial) -> str:
-    bytestring = ser.readline()
-    try:
-        line = bytestring.decode("ascii")
-    except UnicodeDecodeError:
-        # We receive non-ascii/non-utf8 chars from the Linux kernel like 0xea or 0x90
-        # after "Serial: 8250/16550 driver, 16 ports, IRQ sharing enabled"
-        line = str(bytestring)
-        line.replace(r"\n", "\n")
+    # We receive non-ascii/non-utf8 chars from the Linux kernel like 0xea or 0x90
+    # after "Serial: 8250/16550 driver, 16 ports, IRQ sharing enabled"
+    line = ser.readline().decode("ascii", errors="replace")
 
     debug_serial(line)
     return line
@@ -229,7 +292,8 @@ def start_ssh(sysupgrade_firmware_path: str, ap_ip: str = "192.168.1.1", dryrun:
         firmware_target_path = "/tmp/firmware.bin"
 
         # Basic OpenWRT only supports SCP, not SFTP
-        with scp.SCPClient(transport) as scp_client:
+        # The sysupgrade image is already compressed, so only a larger buffer helps, not transport compression
+        with scp.SCPClient(transport, buff_size=SCP_BUFFER_SIZE, socket_timeout=SCP_SOCKET_TIMEOUT) as scp_client:
             scp_client.put(sysupgrade_firmware_path, firmware_target_path)
 
         with transport.open_session() as chan:
@@ -239,18 +303,21 @@ def start_ssh(sysupgrade_firmware_path: str, ap_ip: str = "192.168.1.1", dryrun:
                 sysupgrade_command = sysupgrade_command.replace("sysupgrade", "sysupgrade --test")
                 sysupgrade_command = sysupgrade_command + " && reboot"
             logging.debug(f"Running remote: {sysupgrade_command}")
-            stdout = chan.makefile("r")
-            stderr = chan.makefile_stderr("r")
+            # sysupgrade prints to stderr by default, read both streams as one
+            chan.set_combine_stderr(True)
+            # do not hang forever if the AP reboots without closing the connection
+            chan.settimeout(SSH_READ_TIMEOUT)
+            output = chan.makefile("r")
 
             chan.exec_command(sysupgrade_command)
-            sysupgrade_stdout = stdout.read().decode()
-            sysupgrade_stderr = stderr.read().decode()
-            logging.debug("sysupgrade stdout: %s", sysupgrade_stdout)
-            logging.debug("sysupgrade stderr: %s", sysupgrade_stderr)
-
-            # sysupgrade prints to stderr by default
-            if "Commencing upgrade" in sysupgrade_stderr:
-                logging.info("Flashing in progress...")
+            try:
+                # log output as it arrives, the channel is only closed once sysupgrade stops all processes
+                for line in output:
+                    logging.debug("sysupgrade: %s", line.rstrip())
+                    if "Commencing upgrade" in line:
+                        logging.info("Flashing in progress...")
+            except socket.timeout:
+                logging.debug(f"No sysupgrade output for {SSH_READ_TIMEOUT}s, assuming the AP is rebooting.")
         logging.debug("Closing SSH session.")
 
 
@@ -22,7 +22,12 @@ class TftpServer:
         self.port = port
         self.tftp_server = tftpy.TftpServer(self.tmpdir.name)
         self.tftp_thread = Thread(target=self.tftp_server.listen, args=[self.listenip, self.port])
-        copyfile(self.filepath, os.path.join(self.tmpdir.name, self.filepath.name))
+        served_filepath = os.path.join(self.tmpdir.name, self.filepath.name)
+        try:
+            # avoid copying the image if the temporary directory is on the same filesystem
+            os.link(self.filepath, served_filepath)
+        except OSError:
+            copyfile(self.filepath, served_filepath)
 
     def start(self) -> tftpy.TftpServer:
         logging.info(f"Starting tftp server on {self.listenip}:{self.port} from {self.tmpdir}")
@@ -22,27 +22,31 @@ import logging
 import os
 import pathlib
 import re
-import time
 from threading import Thread
 from typing import Optional, Union
 
 import serial
 
 from .helpers import (
+    SERIAL_BAUDRATE,
+    UBOOT_PROMPTS,
     boot_set_ips,
     boot_wait_for_brlan,
     bootup_interrupt,
     bootup_login,
     bootup_login_verification,
-    debug_serial,
+    event_abort_ssh,
     event_keep_serial_active,
     event_ssh_ready,
     is_kernel_booting,
     keep_logging_until_reboot,
     post_cleanup,
     readline_from_serial,
+    run_uboot_command,
     setting_up_ips,
     start_ssh,
+    wait_for_substring,
+    wait_uboot_prompt,
     write_to_serial,
 )
 from .tftp_server import TftpServer
@@ -54,9 +58,12 @@ SUPPORTED_MODELS = [
     "AP3935",
 ]
 
+_RE_MODEL = re.compile(r"^MODEL=(.*)\r\n", re.MULTILINE)
+_RE_BOOT_OPENWRT = re.compile(r"^boot_openwrt=(.*)\r\n", re.MULTILINE)
+
 
 def get_model_name_from_printenv(printenv: str):
-    model_regex = re.search(r"MODEL=(.*)\r\n", printenv)
+    model_regex = _RE_MODEL.search(printenv)
     if model_regex is None:
         raise RuntimeWarning("no MODEL name found in printenv")
     full_model_name = model_regex.group(1)
@@ -110,19 +117,14 @@ def determine_openwrt_boot_params(model):
 
 
 def bootup_set_boot_openwrt(ser: serial.Serial, dryrun: bool = False) -> str:
-    ser.write(b"printenv\n")
-    time.sleep(1)
-    printenv_return = ser.read(ser.in_waiting).decode("ascii")
-    debug_serial(printenv_return)
+    printenv_return = run_uboot_command(ser, b"printenv\n")
     model = get_model_name_from_printenv(printenv_return)
     boot_openwrt_params = determine_openwrt_boot_params(model)
 
-    if "boot_openwrt" in printenv_return:
+    # a single search both detects and parses boot_openwrt, anchored so "bootcmd=run boot_openwrt" does not match
+    existing_boot_openwrt_params = _RE_BOOT_OPENWRT.search(printenv_return)
+    if existing_boot_openwrt_params is not None:
         logging.debug("Found existing U-Boot boot_openwrt parameter. Verifying.")
-        existing_boot_openwrt_params = re.search(r"boot_openwrt=(.*)\r\n", printenv_return)
-        if not existing_boot_openwrt_params:
-            raise RuntimeError("Unable to parse detected boot_openwrt paramter")
-
         if boot_openwrt_params.decode("ascii") != existing_boot_openwrt_params.group(1):
             # Some AP3825i had wrong and/or outdated boot_openwrt parameters in the past.
             logging.warning(f"Overwriting unexpected param for 'boot_openwrt': {existing_boot_openwrt_params.group(0)}")
@@ -134,24 +136,16 @@ def bootup_set_boot_openwrt(ser: serial.Serial, dryrun: bool = False) -> str:
     else:
         logging.info("Did not find boot_openwrt in U-Boot parameters. Setting it.")
 
-    write_to_serial(ser, b'setenv boot_openwrt "' + boot_openwrt_params + b'"\n')
-    time.sleep(0.5)
-
-    write_to_serial(ser, b'setenv bootcmd "run boot_openwrt"\n')
-    time.sleep(0.5)
+    # keep the long boot_openwrt line separate, batching it could exceed U-Boot's console buffer (CONFIG_SYS_CBSIZE)
+    run_uboot_command(ser, b'setenv boot_openwrt "' + boot_openwrt_params + b'"\n')
+    run_uboot_command(ser, b'setenv bootcmd "run boot_openwrt"\n')
 
     if dryrun:
         logging.info("dryrun: Skipping saveenv")
         return model
 
-    ser.write(b"saveenv\n")
-    if model == "AP3715":
-        time.sleep(6)  # AP3715i has a considerably longer savetime in comparison to others
-    else:
-        time.sleep(2)
-
-    saveenv_return = ser.read(ser.in_waiting).decode("ascii")
-    debug_serial(saveenv_return)
+    # AP3715i has a considerably longer savetime in comparison to others
+    saveenv_return = run_uboot_command(ser, b"saveenv\n", timeout=20)
 
     save_env_success = False
 
@@ -165,6 +159,54 @@ def bootup_set_boot_openwrt(ser: serial.Serial, dryrun: bool = False) -> str:
     return model
 
 
+def abort_on_missing_kernel_image(output: str):
+    if "ERROR: can't get kernel image!" in output:
+        # https://github.com/u-boot/u-boot/blob/8c39999acb726ef083d3d5de12f20318ee0e5070/boot/bootm.c#L123
+        logging.error("Unable to boot initramfs file. Check you provided the correct file. Aborting.")
+
+        # pylint: disable=protected-access
+        os._exit(1)
+
+
+def run_bootm_step(ser: serial.Serial, command: bytes):
+    # U-Boot reports broken images while stepping through bootm, before control is handed to the kernel
+    output = run_uboot_command(ser, command)
+    abort_on_missing_kernel_image(output)
+    if "Wrong Image Format for bootm command" in output:
+        # https://github.com/u-boot/u-boot/blob/8c39999acb726ef083d3d5de12f20318ee0e5070/boot/bootm.c#L974
+        raise RuntimeError("TFTP boot found wrong image format")
+
+
+def wait_for_tftp_transfer(ser: serial.Serial, timeout: float = 120):
+    max_retries = 2
+    cur_retries = 0
+    deadline = serial.serialutil.Timeout(timeout)
+    while event_keep_serial_active.is_set():
+        # Read line-wise: with netretry disabled, the prompt directly follows a failed attempt and must not be skipped
+        marker = wait_for_substring(
+            ser, [b"Bytes transferred", b"Retry count exceeded", *UBOOT_PROMPTS], timeout=deadline.time_left()
+        )
+        if marker == b"Bytes transferred":
+            wait_uboot_prompt(ser)
+            return
+
+        if marker == b"Retry count exceeded":
+            # https://github.com/u-boot/u-boot/blob/8c39999acb726ef083d3d5de12f20318ee0e5070/net/tftp.c#L704
+            logging.warning(f"Failed booting from TFTP (attempt #{cur_retries})")
+            cur_retries = cur_retries + 1
+            if cur_retries > max_retries:
+                write_to_serial(ser, b"\x03")
+                raise RuntimeError(f"Maximum TFTP retries {max_retries} reached. Aborting")
+            continue
+
+        if marker is None and not event_keep_serial_active.is_set():
+            return
+
+        # U-Boot gave up on its own or the transfer did not finish in time
+        write_to_serial(ser, b"\x03")
+        raise RuntimeError("TFTP transfer did not complete")
+
+
 def boot_via_tftp(
     ser: serial.Serial,
     tftp_ip: Union[ipaddress.IPv4Interface, ipaddress.IPv6Interface],
@@ -176,10 +218,14 @@ def boot_via_tftp(
     new_ap_netmask_str = str(new_ap_ip.netmask).encode("ascii")
     tftp_ip_str = str(tftp_ip.ip).encode("ascii")
 
-    write_to_serial(ser, b"setenv ipaddr " + new_ap_ip_str + b"\n")
-    write_to_serial(ser, b"setenv netmask " + new_ap_netmask_str + b"\n")
-    write_to_serial(ser, b"setenv serverip " + tftp_ip_str + b"\n")
-    write_to_serial(ser, b"setenv gatewayip " + tftp_ip_str + b"\n")
+    setenv_commands = [
+        b"setenv ipaddr " + new_ap_ip_str,
+        b"setenv netmask " + new_ap_netmask_str,
+        b"setenv serverip " + tftp_ip_str,
+        b"setenv gatewayip " + tftp_ip_str,
+    ]
+    # send all commands in a single line to avoid waiting for the prompt after each of them
+    run_uboot_command(ser, b"; ".join(setenv_commands) + b"\n")
     logging.info("Did setup TFTP Boot.")
     if model == "AP3710":
         write_to_serial(ser, b"tftpboot 0x1000000 " + tftp_ip_str + b":" + tftp_file.encode("ascii") + b"\n")
@@ -189,70 +235,46 @@ def boot_via_tftp(
         write_to_serial(ser, b"tftpboot 0x2000000 " + tftp_ip_str + b":" + tftp_file.encode("ascii") + b"\n")
     else:
         raise RuntimeError(f"Unknown model {model}")
-    # wait until TFTP transfer is complete
-    while event_keep_serial_active.is_set():
-        line = readline_from_serial(ser)
-
-        if "Bytes transferred" in line:
-            time.sleep(1)
-            break
+    wait_for_tftp_transfer(ser)
     if model == "AP3825":
         # Note: We must step through the `bootm` process manually to avoid fdt relocation.
         # https://git.openwrt.org/?p=openwrt/openwrt.git;a=commit;h=7e614820a89208c4e91a3a5f9de07a5402accdaa
-        write_to_serial(ser, b"interrupts off\n")
-        write_to_serial(ser, b"bootm start 0x2000000\n", sleep=0.2)
-        write_to_serial(ser, b"bootm loados\n", sleep=2)
-        write_to_serial(ser, b"fdt resize\n", sleep=0.1)
-        write_to_serial(ser, b"fdt boardsetup\n", sleep=0.1)
-        write_to_serial(ser, b"fdt chosen\n", sleep=0.1)
-        write_to_serial(ser, b"bootm prep\n", sleep=0.1)
-        write_to_serial(ser, b"bootm go\n", sleep=0.1)
+        run_uboot_command(ser, b"interrupts off\n")
+        run_bootm_step(ser, b"bootm start 0x2000000\n")
+        run_bootm_step(ser, b"bootm loados\n")
+        run_bootm_step(ser, b"fdt resize\n")
+        run_bootm_step(ser, b"fdt boardsetup\n")
+        run_bootm_step(ser, b"fdt chosen\n")
+        run_bootm_step(ser, b"bootm prep\n")
+        write_to_serial(ser, b"bootm go\n")
     elif model == "AP3935":
         # Note: We must step through the `bootm` process manually to avoid fdt relocation.
         # https://git.openwrt.org/?p=openwrt/openwrt.git;a=commit;h=3aef61060e3f51aa43fe494d5ff173e81dd43003
-        write_to_serial(ser, b"bootm start 0x42000000\n", sleep=0.2)
-        write_to_serial(ser, b"bootm loados\n", sleep=2)
-        write_to_serial(ser, b"bootm prep\n", sleep=0.1)
-        write_to_serial(ser, b"bootm go\n", sleep=0.1)
+        run_bootm_step(ser, b"bootm start 0x42000000\n")
+        run_bootm_step(ser, b"bootm loados\n")
+        run_bootm_step(ser, b"bootm prep\n")
+        write_to_serial(ser, b"bootm go\n")
     elif model in ["AP3715", "AP3710"]:
         # See https://git.openwrt.org/?p=openwrt/openwrt.git;a=commit;h=765f66810a3324cc35fa6471ee8eeee335ba8c2b
-        write_to_serial(ser, b"bootm\n", sleep=0.1)
+        write_to_serial(ser, b"bootm\n")
 
     logging.info("Starting TFTP Boot.")
 
 
 def wait_for_ramboot(ser: serial.Serial):
-    max_retries = 2
-    cur_retries = 0
     while event_keep_serial_active.is_set():
         line = readline_from_serial(ser)
+        abort_on_missing_kernel_image(line)
 
-        if "Retry count exceeded" in line:  # TFTP boot failed
-            # https://github.com/u-boot/u-boot/blob/8c39999acb726ef083d3d5de12f20318ee0e5070/net/tftp.c#L704
-            logging.warning(f"Failed booting from TFTP (attempt #{cur_retries}): {line}")
-            cur_retries = cur_retries + 1
-            if cur_retries > max_retries:
-                write_to_serial(ser, b"\x03")
-                raise RuntimeError(f"Maximum TFTP retries {max_retries} reached. Aborting")
-
-        elif "Wrong Image Format for bootm command" in line:
+        if "Wrong Image Format for bootm command" in line:
             # https://github.com/u-boot/u-boot/blob/8c39999acb726ef083d3d5de12f20318ee0e5070/boot/bootm.c#L974
             # do not trigger any other condition, simply retyry when wrong image format was found
             logging.error("TFTP boot found wrong image format")
 
-        elif "ERROR: can't get kernel image!" in line:
-            # https://github.com/u-boot/u-boot/blob/8c39999acb726ef083d3d5de12f20318ee0e5070/boot/bootm.c#L123
-            logging.error("Unable to boot initramfs file. Check you provided the correct file. Aborting.")
-
-            # pylint: disable=protected-access
-            os._exit(1)
-
         elif is_kernel_booting(line):
             logging.info("Booting Linux kernel in RAM")
             break
 
-        time.sleep(0.01)
-
 
 def start_tftp_boot_via_serial(
     name: str,
@@ -261,20 +283,28 @@ def start_tftp_boot_via_serial(
     new_ap_ip: Union[ipaddress.IPv4Interface, ipaddress.IPv6Interface],
     dryrun: bool = False,
 ):
-    with serial.Serial(port=name, baudrate=115200, timeout=30) as ser:
+    with serial.Serial(port=name, baudrate=SERIAL_BAUDRATE, timeout=30) as ser:
         logging.info(f"Starting to connect to serial port {ser.name}")
+        # discard anything received before opening the port, e.g. output of a boot that was already in progress
+        ser.reset_input_buffer()
         event_keep_serial_active.set()
 
-        bootup_interrupt(ser)
-        bootup_login(ser)
-        bootup_login_verification(ser)
-        model = bootup_set_boot_openwrt(ser, dryrun)
-        boot_via_tftp(ser, tftp_ip, tftp_file, new_ap_ip, model)
-        wait_for_ramboot(ser)
-        boot_wait_for_brlan(ser)
-        boot_set_ips(ser, new_ap_ip)
-        event_ssh_ready.set()
-        keep_logging_until_reboot(ser)
+        try:
+            bootup_interrupt(ser)
+            bootup_login(ser)
+            bootup_login_verification(ser)
+            model = bootup_set_boot_openwrt(ser, dryrun)
+            boot_via_tftp(ser, tftp_ip, tftp_file, new_ap_ip, model)
+            wait_for_ramboot(ser)
+            boot_wait_for_brlan(ser)
+            boot_set_ips(ser, new_ap_ip)
+            event_ssh_ready.set()
+            keep_logging_until_reboot(ser)
+        finally:
+            if not event_ssh_ready.is_set():
+                # the serial steps failed or were stopped early, release the waiting SSH thread
+                event_abort_ssh.set()
+                event_ssh_ready.set()
 
 
 def main(
@@ -316,7 +346,10 @@ def main(
         while serial_thread.is_alive():
             serial_thread.join(5)
 
-        logging.info("All steps finished. Give the AP some time to reboot and then access it on http://192.168.1.1")
+        if event_abort_ssh.is_set():
+            logging.error("Flashing aborted, see the errors above.")
+        else:
+            logging.info("All steps finished. Give the AP some time to reboot and then access it on http://192.168.1.1")
     except (KeyboardInterrupt, SystemExit, SystemError):
         logging.warning("Aborting main process")
     finally: